@@ -16,18 +16,65 @@
 # PERFORMANCE OF THIS SOFTWARE.
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
 import functools
+import mmap
+import re
+import select
 import sys
 import time
 import traceback
 
-from pexpect import fdpexpect
-from pexpect.exceptions import TIMEOUT
 import serial
 
+# Responses that do not depend on any runtime value are compiled once here
+# rather than each time they are expected.  A device name is only complete
+# once the CR after it has arrived, so those patterns look ahead for it.
+_PROMPT_RE = re.compile(b'^\r\n>')
+_CRLF_RE = re.compile(b'^\r\n')
+_SYNC_PROMPT_RE = re.compile(b'\r\n>')
+_ADVANCED_SETUP_RE = re.compile(b'^AS\r> ADVANCED SETUP')
+_CHECKSUM_RE = re.compile(b'^\r\nSUM = ([0-9A-F]{8})\r\n>')
+_CHKSUM_DEVICE_RE = re.compile(b'^CR\r>CHKSUM [^\r]+(?=\r)')
+_START_END_RE = re.compile(b'^\r\n[0-9A-F]{5},[0-9A-F]{5},\b \b{12}')
+_START_END_LEN = len(b'\r\n00000,7FFFF,\b ' + b'\b' * 12)
+_COMMA_RE = re.compile(b',')
+_BACKSPACE_RE = re.compile(b'^\b')
+_CR_RE = re.compile(b'^\r')
+_CHECKSUM_RAM_RE = re.compile(b'^CH\r>CHECKSUM RAM')
+_RECEIVE_BINARY_RE = re.compile(b'^RE\r>RECEIVE BINARY  ')
+_SEND_BINARY_RE = re.compile(b'^SE\r>SEND BINARY  ')
+_EMULATE_RE = re.compile(b'^EM\r>EMULATE [^\r]+(?=\r)')
+
+@functools.lru_cache(maxsize=None)
+def _named_byte_re(name):
+    # Advanced setup shows the same few fields every time, so each field's
+    # pattern is only built and compiled the first time it is needed.
+    return re.compile(f'^\r\n{name:15}([0-9A-F]{{2}})\b\b'.encode('ascii'))
+
+def data_checksum(data):
+    # The S4 reports its checksum as the 32-bit sum of the bytes.  Going
+    # through a memoryview lets data be any buffer, such as an mmap, that
+    # does not iterate as integers.
+    with memoryview(data) as view:
+        return sum(view) & 0xFFFFFFFF
+
+def _map_or_read(binary_file):
+    # Map the file rather than reading it so the data is not copied onto
+    # the heap before being sent.  Pipes, such as stdin, and empty files
+    # cannot be mapped, so those are read instead.
+    try:
+        return mmap.mmap(binary_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return contextlib.nullcontext(binary_file.read())
+
 class DatamanS4:
     ESCAPE = '\x1B'
     S4_MEM_SIZE = 512 * 1024
+    ADDR_CHUNK_SIZE = 1
+    RESPONSE_TIMEOUT = 0.5
+    WRITE_CHUNK_SIZE = 4096
 
     def __init__(self, port, baud, size = None, debug=False):
         self.mem_start = 0
@@ -35,20 +82,34 @@ class DatamanS4:
             size = DatamanS4.S4_MEM_SIZE
         self.mem_size = size
 
-        self.ser = serial.Serial(port, baud, rtscts = True)
-        self.exp = fdpexpect.fdspawn(self.ser.fileno(), timeout=0.5)
-
         self.debug = debug
 
+        # Reads never block: _receive() waits for data with select(), so the
+        # timeout never has to be changed, which would reconfigure the port.
+        self.ser = serial.Serial(port, baud, rtscts = True, timeout=0)
+        # Data read from the S4 that has not been matched yet.
+        self.received = b''
+
+        # On Linux, USB serial adapters such as FTDI's hold received data
+        # for up to 16 ms before passing it on unless the port is in low
+        # latency mode, which adds that delay to every response.
+        if sys.platform.startswith('linux'):
+            try:
+                self.ser.set_low_latency_mode(True)
+            except ValueError as exc:
+                # Not every serial driver supports it.
+                if self.debug:
+                    print(exc, file=sys.stderr)
+
         # To ensure we are in sync with the S4, send an escape character,
         # delay for a short while, flush whatever input we received on the
         # serial port and finally send a carriage return expecting to receive
         # a prompt.
-        self.exp.send(self.ESCAPE)
+        self._send(self.ESCAPE)
         time.sleep(0.2)
         self.ser.reset_input_buffer()
-        self.exp.send('\r')
-        self._expect('\r\n>')
+        self._send('\r')
+        self._read_frame(_SYNC_PROMPT_RE)
 
     @property
     def mem_end(self):
@@ -58,26 +119,83 @@ class DatamanS4:
     def mem_end(self, end):
         self.mem_size = end - self.mem_start + 1
 
+    def _timed_out(self):
+        raise TimeoutError(f'Timeout waiting for the S4 after receiving '
+                           f'{self.received!r}')
+
+    def _log_expected(self, expected, got):
+        if self.debug:
+            print(f'expected {expected.pattern!r:64} got {got!r}',
+                  file=sys.stderr)
+
+    def _deadline(self, timeout=-1):
+        if timeout == -1:
+            timeout = self.RESPONSE_TIMEOUT
+        return time.monotonic() + timeout
+
+    def _receive(self, deadline, size=None):
+        # Wait for data and then take everything that has arrived, up to
+        # size bytes, rather than reading a byte at a time.
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            self._timed_out()
+        ready, _, _ = select.select([self.ser.fileno()], [], [], remaining)
+        if not ready:
+            self._timed_out()
+        self.received += self.ser.read(size or max(1, self.ser.in_waiting))
+
     def _expect(self, expected, timeout=-1):
-        self.exp.expect(expected, timeout=timeout)
-        assert self.exp.before == b''
+        # Read whatever has arrived until the expected response is at the
+        # start of what has been received.
+        expected = re.compile(expected)
+        deadline = self._deadline(timeout)
+        while (match := expected.match(self.received)) is None:
+            self._receive(deadline)
+        self.received = self.received[match.end():]
+        self._log_expected(expected, match.group(0))
+        return match
+
+    def _read_frame(self, expected, terminator=b'>', size=64, timeout=-1):
+        # For responses with a known terminator, the pattern is only
+        # checked once the whole response has arrived.  pyserial's
+        # read_until() would read it a byte at a time.
+        deadline = self._deadline(timeout)
+        while (end := self.received.find(terminator)) < 0:
+            assert len(self.received) < size
+            self._receive(deadline)
+        end += len(terminator)
+        frame, self.received = self.received[:end], self.received[end:]
+        match = expected.fullmatch(frame)
+        assert match is not None
+        self._log_expected(expected, frame)
+        return match
+
+    def _read_exact(self, size):
+        # Allow for the time to transfer the data at 10 bits per byte.
+        deadline = self._deadline(self.RESPONSE_TIMEOUT
+                                  + size * 10 / self.ser.baudrate)
+        while len(self.received) < size:
+            self._receive(deadline, size - len(self.received))
+        data, self.received = self.received[:size], self.received[size:]
         if self.debug:
-            print(f'expected {expected!r:64} got {self.exp.after!r}',
+            print(f'read {data!r}' if size <= 64 else f'read {size} bytes',
                   file=sys.stderr)
+        return data
 
     def _send(self, to_send):
-        self.exp.send(to_send)
+        if isinstance(to_send, str):
+            to_send = to_send.encode('ascii')
+        self.ser.write(to_send)
         if self.debug:
             print(f'sent {to_send!r}', file=sys.stderr)
 
     def _set_named_byte(self, name, value=None, last_value=False):
         assert(value is None or 0 <= value <= 255)
-        expected = f'^\r\n{name:15}([0-9A-F]{{2}})\b\b'
-        self._expect(expected)
-        current_value = int(self.exp.match.group(1), 16)
+        match = self._read_frame(_named_byte_re(name), terminator=b'\b\b')
+        current_value = int(match.group(1), 16)
         if value is not None and value != current_value:
             self._send(f'{value:02X}')
-            self._expect(f'^{value:02X}\b')
+            self._expect(b'^%02X\b' % value)
         if last_value:
             self._send(self.ESCAPE)
         else:
@@ -95,7 +213,7 @@ class DatamanS4:
             busy_tone = 0x50
 
         self._send('as')
-        self._expect('^AS\r> ADVANCED SETUP')
+        self._expect(_ADVANCED_SETUP_RE)
         self._set_named_byte('Shutdown Time')
         self._set_named_byte('High Tone', high_tone)
         self._set_named_byte('Low Tone', low_tone)
@@ -106,43 +224,48 @@ class DatamanS4:
         self._set_named_byte('Discharge Time')
         self._set_named_byte('Deep Discharge')
         self._set_named_byte('Norm Discharge', last_value=True)
-        self._expect('^\r\n>')
+        self._read_frame(_PROMPT_RE)
 
     def _get_checksum(self, size):
         # I measured that it takes the S4 a little under 21 seconds to
         # checksum all 512K of its memory.
-        timeout = self.exp.timeout + size * 21 / self.S4_MEM_SIZE
-        self._expect('^\r\nSUM = ([0-9A-F]{8})\r\n>', timeout=timeout)
-        return int(self.exp.match.group(1), 16)
+        timeout = self.RESPONSE_TIMEOUT + size * 21 / self.S4_MEM_SIZE
+        match = self._read_frame(_CHECKSUM_RE, timeout=timeout)
+        return int(match.group(1), 16)
 
     def checksum_device(self):
         # SUM KEY green (CR) page 49
         self._send('cr')
-        self._expect('^CR\r>CHKSUM [^\r]+')
+        self._expect(_CHKSUM_DEVICE_RE)
         # Use mem_size as a proxy for actually knowing the target device size
         return self._get_checksum(self.mem_size)
 
-    def _set_start_end(self):
-        self._expect('^\r\n[0-9A-F]{5},[0-9A-F]{5},\b \b{12}')
+    def _send_address(self, address):
         # Initially, I transmitted all the digits at once, but the S4
-        # would occasionally drop characters when responding.
-        to_send = f'{self.mem_start:05X}'
-        for each_ch in to_send:
-            self._send(each_ch)
-            self._expect(f'^{each_ch}')
-        self._expect(',')
-        to_send = f'{self.mem_end:05X}'
-        for each_ch in to_send:
-            self._send(each_ch)
-            self._expect(f'^{each_ch}')
-        self._expect('^\b')
+        # would occasionally drop characters when responding, so each digit
+        # waits for its echo.  Raising ADDR_CHUNK_SIZE sends that many digits
+        # per echo, which saves round trips but is untested on an S4.
+        to_send = b'%05X' % address
+        for i in range(0, len(to_send), self.ADDR_CHUNK_SIZE):
+            chunk = to_send[i:i + self.ADDR_CHUNK_SIZE]
+            self._send(chunk)
+            self._expect(b'^' + chunk)
+
+    def _set_start_end(self):
+        # The current range is always the same length, so read it whole.
+        current_range = self._read_exact(_START_END_LEN)
+        assert _START_END_RE.fullmatch(current_range)
+        self._send_address(self.mem_start)
+        self._expect(_COMMA_RE)
+        self._send_address(self.mem_end)
+        self._expect(_BACKSPACE_RE)
         self._send('\r')
-        self._expect('^\r')
+        self._expect(_CR_RE)
 
     def checksum_mem(self):
         # SUM KEY grey (CH) page 58
         self._send('ch')
-        self._expect('^CH\r>CHECKSUM RAM')
+        self._expect(_CHECKSUM_RAM_RE)
         self._set_start_end()
         return self._get_checksum(self.mem_size)
 
@@ -151,27 +274,40 @@ class DatamanS4:
         # TODO: Add option to fill with specified character if too short.
         assert len(data) == self.mem_size
         self._send('re')
-        self._expect('^RE\r>RECEIVE BINARY  ')
+        self._expect(_RECEIVE_BINARY_RE)
         self._set_start_end()
-        self._send(data)
+        # pyserial keeps writing until all of the data has gone out and
+        # accepts any buffer, such as an mmap.  Writing in chunks through a
+        # memoryview means pyserial only ever copies one chunk at a time.
+        with memoryview(data) as view:
+            for offset in range(0, len(view), self.WRITE_CHUNK_SIZE):
+                # Release each slice so no reference to data outlives this
+                # call, which would stop the caller closing an mmap.
+                with view[offset:offset + self.WRITE_CHUNK_SIZE] as chunk:
+                    self.ser.write(chunk)
+                    if self.debug:
+                        print(f'sent {offset + len(chunk)} of {len(view)} '
+                              f'bytes', file=sys.stderr)
         self.ser.flush()
-        time.sleep(1.1)
-        self._expect('^\r\n>')
+        # The S4 can take over a second after the last byte to prompt.
+        # Rather than always sleeping for that long, allow for it in the
+        # timeout so the prompt is read as soon as it arrives.
+        self._read_frame(_PROMPT_RE, timeout=self.RESPONSE_TIMEOUT + 1.1)
 
     def data_from_s4(self):
         # SEND (SE) pg 62
         self._send('se')
-        self._expect('^SE\r>SEND BINARY  ')
+        self._expect(_SEND_BINARY_RE)
         self._set_start_end()
-        self._expect(f'^\r\n(.{{{self.mem_size}}})')
-        data = self.exp.match.group(1)
-        self._expect('^\r\n>')
+        self._expect(_CRLF_RE)
+        data = self._read_exact(self.mem_size)
+        self._read_frame(_PROMPT_RE)
         return data
 
     def emulate(self):
         # EMUL (EM) pg 41
         self._send('em')
-        self._expect('^EM\r>EMULATE [^\r]+')
+        self._expect(_EMULATE_RE)
 
 def main():
     prog_description = 's4: Send a binary file to a Dataman S4'
@@ -207,9 +343,12 @@ def main():
     try:
         if args.mute:
             s4.advanced_setup(mute=True)
-        data_to = args.binary_file.read()
-        s4.data_to_s4(data_to)
-        chksum = sum(data_to)
+        with _map_or_read(args.binary_file) as data_to:
+            # Sum the data while it is being sent rather than afterwards.
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                chksum_future = executor.submit(data_checksum, data_to)
+                s4.data_to_s4(data_to)
+                chksum = chksum_future.result()
         if args.verbose:
             print(f'0x{chksum:08X}')
         assert chksum == s4.checksum_mem()
@@ -218,14 +357,13 @@ def main():
 
         # Examples of other functions:
         # data_from = s4.data_from_s4()
-        # assert chksum == sum(data_from)
+        # assert chksum == data_checksum(data_from)
         # print(f'0x{s4.checksum_device():08X}')
 
-    except TIMEOUT as exc:
+    except TimeoutError as exc:
         print('==== EXCEPTION ====')
         traceback.print_exception(None, exc, exc.__traceback__)
-        print(f'{s4.exp.before =}')
-        print(f'{s4.exp.after =}')
+        print(f'{s4.received =}')
         return 1
 
     return 0